@@ -7,31 +7,46 @@ files. To check if all exported files are there, Google creates an HTML file lis
 This script check this HTML file and compare with the exported files, after you extract all compressed files.
 
 It needs beautifulsoup. You can get with: "pip install beautifulsoup4".
+If lxml is installed ("pip install lxml"), it is used as the HTML parser, which is way faster on big exports.
 """
 import os
 import argparse
 from bs4 import BeautifulSoup, Tag
 from pprint import pprint
+try:
+    import lxml
+    HTML_PARSER = "lxml"
+except ImportError:
+    HTML_PARSER = "html.parser"
 
-def parse_directory(tag: Tag, directory: str):
+def list_directory(directory: str) -> dict[str, bool]:
+    """Lists a directory once, telling for each name if it is a directory."""
+    with os.scandir(directory) as entries:
+        return {entry.name: entry.is_dir() for entry in entries}
+
+def parse_directory(tag: Tag, directory: str, entries: dict[str, bool]):
     """Check if all files described in an directory (inside navigator HTML) are there.
+    The directory entries are listed only once, so only names missing there need a stat.
     It calls itself to descend all tree."""
     children = tag.children
     first_child = next(children)
     child_class = first_child['class'][0]
     # We get a folder
     if child_class == "extracted-folder":
-        folder_name = first_child.find_next("div").text
-        folder_name = os.path.join(directory, folder_name.strip())
-        if not os.path.isdir(folder_name):
+        folder = first_child.find_next("div").text.strip()
+        folder_name = os.path.join(directory, folder)
+        # On a miss, the OS may still resolve the name (like NFD names on HFS+, or trailing dots on Windows)
+        if not entries.get(folder, False) and not os.path.isdir(folder_name):
             print(f'Folder "{folder_name}" not found!')
             return
+        folder_entries = list_directory(folder_name)
         for child in children:
-            parse_directory(child, folder_name)
+            parse_directory(child, folder_name, folder_entries)
     elif child_class == "file-leaf":
-        filename = first_child.next.text
-        fullname = os.path.join(directory, filename.strip())
-        if not os.path.isfile(fullname):
+        filename = first_child.next.text.strip()
+        fullname = os.path.join(directory, filename)
+        # Missing names, or directories, are not the expected file, unless the OS resolves the name anyway
+        if entries.get(filename, True) and not os.path.isfile(fullname):
             print(f'"{fullname}" was not found!')
     else:
         raise Exception("unknown type")
@@ -46,9 +61,10 @@ def parse_html_file(file: BeautifulSoup, directory: str):
         if not os.path.isdir(service_path):
             print(f"Not found!")
             continue
+        entries = list_directory(service_path)
         rows = service.find("div", class_="extracted-list").children
         for row in rows:
-            parse_directory(row, service_path)
+            parse_directory(row, service_path, entries)
 
 def main():
     parser = argparse.ArgumentParser(description="Check if all backup'ed files from Google Takeout are here, once you extract all compressed files. Need to inform navigator.html.",
@@ -60,7 +76,7 @@ def main():
         print(f"Error! {navigator_file} not found!")
         exit(1)
     with open(navigator_file, encoding="utf-8") as handle:
-        html = BeautifulSoup(handle, "html.parser")
+        html = BeautifulSoup(handle, HTML_PARSER)
         parse_html_file(html, os.path.dirname(navigator_file))
 
 if __name__ == "__main__":
@@ -24,14 +24,16 @@ import os
 import json
 import argparse
 import shutil
-from datetime import datetime, timezone
+import time
+import re
 import unicodedata
 import subprocess
+import functools
 
 LATITUDE_REF = ('N', 'S')
 LONGITUDE_REF = ('E', 'W')
 EXTENSIONS = ['.jpg', '.png', '.heic', '.heif', '.mp4']
-DATETIME_STR_FORMAT = "%Y:%m:%d %H:%M:%S"
+COMBINING_MARKS = re.compile('[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]')
 
 
 class GPSData:
@@ -54,7 +56,7 @@ class GPSData:
         if self.altitude != 0.0:
             params += [
                 f"-GPSAltitude={abs(self.altitude)}",
-                f"-GPSAltitude={abs(self.altitude)}"
+                f"-GPSAltitudeRef={'Above' if self.altitude >= 0.0 else 'Below'} Sea Level"
             ]
         return params
 
@@ -63,62 +65,83 @@ class MediaDates:
     __slots__ = ['taken_time', 'creation_time']
 
     def __init__(self, taken_time: dict[str, str], creation_time: dict[str, str]):
-        self.taken_time = datetime.fromtimestamp(float(taken_time.get('timestamp', 0.0)), timezone.utc)
-        self.creation_time = datetime.fromtimestamp(float(creation_time.get('timestamp', 0.0)), timezone.utc)
+        self.taken_time = format_timestamp(taken_time.get('timestamp', 0))
+        self.creation_time = format_timestamp(creation_time.get('timestamp', 0))
     
     def to_params(self) -> list[str]:
-        taken_time = self.taken_time.strftime(DATETIME_STR_FORMAT)
-        creation_time = self.creation_time.strftime(DATETIME_STR_FORMAT)
         return [
-            f"-DateTimeOriginal={taken_time}",
-            f"-CreateDate={creation_time}",
-            f"-ModifyDate={creation_time}"
+            f"-DateTimeOriginal={self.taken_time}",
+            f"-CreateDate={self.creation_time}",
+            f"-ModifyDate={self.creation_time}"
         ]
 
 
+def format_timestamp(timestamp: str) -> str:
+    """Formats an UTC timestamp as an EXIF datetime, without building datetime objects."""
+    year, month, day, hour, minute, second = time.gmtime(int(float(timestamp)))[:6]
+    return f"{year:04d}:{month:02d}:{day:02d} {hour:02d}:{minute:02d}:{second:02d}"
+
+
+@functools.lru_cache(maxsize=16384)
 def normalize_ascii(texto):
     """Only ASCII characteres are accepted as EXIF description.
-    This function uses normalization technique to remove/convert non-ASCII characters."""
-    normalized_text = unicodedata.normalize('NFKD', texto)
-    return ''.join(
-        char for char in normalized_text if unicodedata.category(char) != 'Mn'
-    )
+    This function uses normalization technique to remove/convert non-ASCII characters.
+    Descriptions repeat a lot across media, so results are cached."""
+    return COMBINING_MARKS.sub('', unicodedata.normalize('NFKD', texto))
 
-def try_get_file(dir: str, file: str) -> str:
+def try_get_file(dir: str, file: str, dir_files: set[str]) -> str:
     """The "title" metadata field references the file name, but I noticed that,
     on old media ingested, the extension is missing. This function tries to guess based on common extension.
     Also, for some photos that are excluded, the respective metadata are still exported, so it is better
-    to check if file really exists."""
+    to check if file really exists. The directory files names are given, so a stat is needed only when
+    the exact name is not there (on case-insensitive filesystems, it may have another case)."""
     file_ext = os.path.splitext(file)[1].lower()
     if file_ext:
         file_path = os.path.join(dir, file)
-        if not os.path.isfile(file_path):
+        if file not in dir_files and not os.path.isfile(file_path):
             raise Exception(f'File not found: "{file_path}"')
         return file_path
     for file_ext in EXTENSIONS:
-        file_path = os.path.join(dir, f"{file}.{file_ext}")
+        if f"{file}{file_ext}" in dir_files:
+            return os.path.join(dir, f"{file}{file_ext}")
+    # On case-insensitive filesystems, the file may be there with another case (like ".JPG")
+    for file_ext in EXTENSIONS:
+        file_path = os.path.join(dir, f"{file}{file_ext}")
         if os.path.isfile(file_path):
             return file_path
     raise Exception(f'Could not find any extension for file: "{os.path.join(dir, file)}"')
 
-def add_media_metadata(exiftool_exe: str, dir: str, metadata: dict):
+def run_exiftool(cmd: list[str]):
+    """Runs ExifTool, discarding its output. Where available, it uses posix_spawn,
+    skipping the fork and pipes bookkeeping done by subprocess for each file."""
+    if not hasattr(os, "posix_spawnp"):
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        return
+    file_actions = [
+        (os.POSIX_SPAWN_OPEN, 1, os.devnull, os.O_WRONLY, 0),
+        (os.POSIX_SPAWN_OPEN, 2, os.devnull, os.O_WRONLY, 0)
+    ]
+    pid = os.posix_spawnp(cmd[0], cmd, os.environ, file_actions=file_actions)
+    os.waitpid(pid, 0)
+
+def add_media_metadata(exiftool_exe: str, dir: str, dir_files: set[str], metadata: dict):
     """Core of the script, adds metadata to file."""
     title = metadata['title']
     try:
-        file_path = try_get_file(dir, title)
+        file_path = try_get_file(dir, title, dir_files)
     except Exception as e:
         print("[!]", e)
         return
     cmd = [exiftool_exe, "-overwrite_original"]
     dates = MediaDates(metadata.get('photoTakenTime', {}), metadata.get('creationTime', {}))
-    description = metadata.get('description')
+    description = normalize_ascii(metadata.get('description') or '')
     geo = GPSData(metadata.get('geoData', {}))
     if description:
-        cmd.append(f"-Description={normalize_ascii(description)}")
+        cmd.append(f"-Description={description}")
     cmd += dates.to_params()
     cmd += geo.to_params()
     cmd.append(file_path)
-    subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    run_exiftool(cmd)
 
 
 
@@ -142,6 +165,7 @@ def main():
     for dir, _, files in os.walk(base_dir):
         last_dir = os.path.basename(dir.rstrip(os.path.sep))
         print(f'[*] Parsing media at "{dir}"')
+        dir_files = set(files)
         for file in files:
             if not file.endswith(".json"):
                 continue
@@ -151,7 +175,7 @@ def main():
             title = metadata.get('title')
             if title is None or title == last_dir:
                 continue
-            add_media_metadata(exiftool_exe, dir, metadata)
+            add_media_metadata(exiftool_exe, dir, dir_files, metadata)
             # Move metadata file to folder
             if metadata_folder:
                 new_metadata_path = os.path.join(metadata_folder, metadata_fullpath[len(base_dir)+1:])
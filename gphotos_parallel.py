@@ -19,21 +19,47 @@ without holding tons of JSON files.
 
 This script can also moves metadata from original folder to another. Just in case you want to bulk inport photos without
 the JSON, or to exclude them easily.
+
+If orjson is installed ("pip install orjson"), it is used to parse the JSON files faster.
 """
 import os
+import errno
 import pathlib
-import json
 import argparse
 import shutil
-from datetime import datetime, timezone
+import time
+import re
 import unicodedata
 import subprocess
+import functools
+import collections
+import threading
 from concurrent import futures
+from multiprocessing.util import Finalize
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
 LATITUDE_REF = ('N', 'S')
 LONGITUDE_REF = ('E', 'W')
 EXTENSIONS = ['.jpg', '.jpeg', '.png', '.gif', '.heic', '.heif', '.mp4', '.mov']
-DATETIME_STR_FORMAT = "%Y:%m:%d %H:%M:%S"
+COMBINING_MARKS = re.compile('[\u0300-\u036f\u1ab0-\u1aff\u1dc0-\u1dff\u20d0-\u20ff\ufe20-\ufe2f]')
+# Maximum JSON files, from the same folder, handled at once by a worker process
+BATCH_SIZE = 64
+# Batches in flight for each worker process, so they never wait for work, but futures do not pile up
+PENDING_PER_WORKER = 4
+# Seconds between progress messages
+PROGRESS_INTERVAL = 1.0
+MEDIA_METADATA_SUFFIX = ".supplemental-metadata.json"
+# JSON files exported by Google Photos that are not about a media file
+NON_MEDIA_METADATA_NAMES = {"metadata.json", "print-subscriptions.json", "shared_album_comments.json",
+                            "user-generated-memory-titles.json"}
+# Takeout metadata starts with the "title" field, so album metadata can be told apart reading only a few bytes
+TITLE_PREFIX_SIZE = 512
+TITLE_FIELD = re.compile(rb'"title"\s*:\s*"([^"\\]*)"')
+# Printed by ExifTool after each numbered "-execute"
+READY_SENTINEL = b"{ready%d}"
 
 
 class GPSData:
@@ -44,19 +70,19 @@ class GPSData:
         self.longitude: float = geoData.get('longitude', 0.0)
         self.altitude: float = geoData.get('altitude', 0.0)
 
-    def to_params(self) -> list[str]:
+    def to_params(self) -> list[bytes]:
         if self.latitude == 0.0 and self.longitude == 0.0:
             return []
         params = [
-            f"-GPSLatitude={abs(self.latitude)}",
-            f"-GPSLatitudeRef={'N' if self.latitude >= 0.0 else 'S'}",
-            f"-GPSLongitude={abs(self.longitude)}",
-            f"-GPSLongitudeRef={'E' if self.longitude >= 0 else 'W'}"
+            b"-GPSLatitude=%.7f" % abs(self.latitude),
+            b"-GPSLatitudeRef=N" if self.latitude >= 0.0 else b"-GPSLatitudeRef=S",
+            b"-GPSLongitude=%.7f" % abs(self.longitude),
+            b"-GPSLongitudeRef=E" if self.longitude >= 0.0 else b"-GPSLongitudeRef=W"
         ]
         if self.altitude != 0.0:
             params += [
-                f"-GPSAltitude={abs(self.altitude)}",
-                f"-GPSAltitude={abs(self.altitude)}"
+                b"-GPSAltitude=%.7f" % abs(self.altitude),
+                b"-GPSAltitudeRef=Above Sea Level" if self.altitude >= 0.0 else b"-GPSAltitudeRef=Below Sea Level"
             ]
         return params
 
@@ -65,74 +91,317 @@ class MediaDates:
     __slots__ = ['taken_time', 'creation_time']
 
     def __init__(self, taken_time: dict[str, str], creation_time: dict[str, str]):
-        self.taken_time = datetime.fromtimestamp(float(taken_time.get('timestamp', 0.0)), timezone.utc)
-        self.creation_time = datetime.fromtimestamp(float(creation_time.get('timestamp', 0.0)), timezone.utc)
+        self.taken_time = format_timestamp(taken_time.get('timestamp', 0))
+        self.creation_time = format_timestamp(creation_time.get('timestamp', 0))
     
-    def to_params(self) -> list[str]:
-        taken_time = self.taken_time.strftime(DATETIME_STR_FORMAT)
-        creation_time = self.creation_time.strftime(DATETIME_STR_FORMAT)
+    def to_params(self) -> list[bytes]:
         return [
-            f"-DateTimeOriginal={taken_time}",
-            f"-CreateDate={creation_time}",
-            f"-ModifyDate={creation_time}"
+            b"-DateTimeOriginal=" + self.taken_time,
+            b"-CreateDate=" + self.creation_time,
+            b"-ModifyDate=" + self.creation_time
         ]
 
 
+def format_timestamp(timestamp: str) -> bytes:
+    """Formats an UTC timestamp as an EXIF datetime, without building datetime objects."""
+    return b"%04d:%02d:%02d %02d:%02d:%02d" % time.gmtime(int(float(timestamp)))[:6]
+
+
+@functools.lru_cache(maxsize=16384)
 def normalize_ascii(texto):
     """Only ASCII characteres are accepted as EXIF description.
-    This function uses normalization technique to remove/convert non-ASCII characters."""
-    normalized_text = unicodedata.normalize('NFKD', texto)
-    return ''.join(
-        char for char in normalized_text if unicodedata.category(char) != 'Mn'
-    )
-
-def add_media_metadata(exiftool_exe: str, media_path: str, metadata: dict):
-    """Core of the script, adds metadata to file."""
-    title = metadata['title']
-    cmd = [exiftool_exe, "-overwrite_original"]
+    This function uses normalization technique to remove/convert non-ASCII characters.
+    Descriptions repeat a lot across media, so results are cached."""
+    return COMBINING_MARKS.sub('', unicodedata.normalize('NFKD', texto))
+
+class ExifTool:
+    """A long-lived ExifTool process, running in "-stay_open" mode.
+    Starting ExifTool (a Perl interpreter, plus its modules) for each file is way slower
+    than the metadata writing itself, so the arguments are sent through its stdin instead."""
+    __slots__ = ['process']
+
+    def __init__(self, exiftool_exe: str):
+        # File names are sent as UTF-8 lines, which ExifTool does not assume on Windows
+        self.process = subprocess.Popen([exiftool_exe, "-stay_open", "True", "-@", "-",
+                                         "-common_args", "-charset", "filename=utf8"],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+    def _read_until_ready(self, stream, ready: bytes) -> str:
+        lines = []
+        while True:
+            line = stream.readline()
+            if not line:
+                raise Exception("ExifTool process exited unexpectedly.")
+            line = line.rstrip(b"\r\n")
+            if line == ready:
+                return "\n".join(lines)
+            lines.append(line.decode(errors="replace"))
+
+    def execute(self, commands: list[list[bytes]]) -> list[str]:
+        """Runs some commands (each one a list of arguments, one per line).
+        Arguments are already bytes, as they go straight to the ExifTool stdin.
+        Each command output is read before the next one is written, so neither side
+        blocks on a full pipe (Windows pipes buffer only a few KB).
+        Returns each command error messages, if any."""
+        errors = []
+        for number, args in enumerate(commands):
+            ready = READY_SENTINEL % number
+            lines = args + [b"-echo4", ready, b"-execute%d" % number]
+            self.process.stdin.write(b"\n".join(lines) + b"\n")
+            self.process.stdin.flush()
+            self._read_until_ready(self.process.stdout, ready)
+            stderr = self._read_until_ready(self.process.stderr, ready)
+            errors.append("\n".join(line for line in stderr.splitlines() if line.startswith("Error")))
+        return errors
+
+    def close(self):
+        try:
+            self.process.stdin.write(b"-stay_open\nFalse\n")
+            self.process.stdin.flush()
+        except OSError:
+            # It has already exited
+            pass
+        self.process.communicate()
+
+    def kill(self):
+        self.process.kill()
+        self.process.communicate()
+
+
+def argfile_line(arg: bytes) -> bytes:
+    """ExifTool reads one argument per line, so arguments with line breaks must use C escape sequences."""
+    if b"\n" not in arg and b"\r" not in arg:
+        return arg
+    escaped = arg.replace(b"\\", b"\\\\").replace(b"\r", b"\\r").replace(b"\n", b"\\n")
+    return b"#[CSTR]" + escaped
+
+
+def media_params(media_path: str, metadata: dict) -> list[bytes]:
+    """Core of the script, builds the ExifTool arguments to add metadata to file."""
+    args = [b"-overwrite_original"]
     dates = MediaDates(metadata.get('photoTakenTime', {}), metadata.get('creationTime', {}))
-    description = metadata.get('description')
+    description = normalize_ascii(metadata.get('description') or '')
     geo = GPSData(metadata.get('geoData', {}))
     if description:
-        cmd.append(f"-Description={normalize_ascii(description)}")
-    cmd += dates.to_params()
-    cmd += geo.to_params()
-    cmd.append(media_path)
-    result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if result.returncode != 0:
-        return result.stderr.decode()
-    return ""
-
-
-def prepare_process(base_dir: pathlib.Path, metadata_dir: pathlib.Path):
-    def process_json_file(exiftool_exe: str, json_path: pathlib.Path) -> str:
-        with json_path.open(encoding="utf-8") as handle:
-            metadata: dict = json.load(handle)
-        title: str = metadata.get('title', '')
-        json_dir = json_path.parent
-        if not title or title == json_dir.name:
-            return
-        media_file = json_dir / title
-        # If media file has no extension (some old media has that issue)
-        if not media_file.suffix:
-            # Try all common extension
+        args.append(argfile_line(b"-Description=" + description.encode()))
+    args += dates.to_params()
+    args += geo.to_params()
+    args.append(os.fsencode(media_path))
+    return args
+
+
+# Each worker process ExifTool, started by init_worker
+worker_exiftool: ExifTool = None
+worker_exiftool_exe: str = None
+
+
+def init_worker(exiftool_exe: str):
+    """Runs once on each worker process, starting the process own ExifTool."""
+    global worker_exiftool, worker_exiftool_exe
+    worker_exiftool_exe = exiftool_exe
+    worker_exiftool = ExifTool(exiftool_exe)
+    Finalize(None, close_worker, exitpriority=10)
+
+
+def close_worker():
+    worker_exiftool.close()
+
+
+def restart_worker():
+    """Replaces the worker ExifTool, after it died (or broke its output) on some file."""
+    global worker_exiftool
+    worker_exiftool.kill()
+    worker_exiftool = ExifTool(worker_exiftool_exe)
+
+
+def is_media_metadata(name: str) -> bool:
+    if name.endswith(MEDIA_METADATA_SUFFIX):
+        return True
+    # Cropped media metadata names only end with ".json"
+    return name.endswith(".json") and name not in NON_MEDIA_METADATA_NAMES
+
+
+def find_json_files(directory: str, skip_dir: str = None):
+    """Yields all media metadata JSON files paths inside directory, recursively, in batches from the same folder.
+    The file types come from the directory entries, so no stat is needed for each file.
+    It uses a stack instead of recursion, so deep trees do not pile up generators (nor open directories).
+    The skip_dir (a real path) is not walked: metadata files are moved there while the walk goes on."""
+    pending = [directory]
+    while pending:
+        batch = []
+        with os.scandir(pending.pop()) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if skip_dir is None or os.path.realpath(entry.path) != skip_dir:
+                        pending.append(entry.path)
+                elif is_media_metadata(entry.name):
+                    batch.append(entry.path)
+                    if len(batch) == BATCH_SIZE:
+                        yield batch
+                        batch = []
+        if batch:
+            yield batch
+
+
+@functools.lru_cache(maxsize=256)
+def list_directory(directory: str) -> frozenset[str]:
+    """Names inside a directory. It is cached, so all JSON files from a folder share a single listing,
+    instead of checking each media file (and each extension guess) with a stat.
+    The names are exact, so a miss still needs a stat on case-insensitive filesystems."""
+    return frozenset(os.listdir(directory))
+
+
+def read_media_params(json_path: pathlib.Path) -> list[bytes]:
+    """Reads a media metadata file and finds its media file, returning the ExifTool arguments to update it.
+    If the JSON is not about a media file, returns an empty list."""
+    json_dir = json_path.parent
+    # Album metadata, no need to open it
+    if json_path.stem == json_dir.name:
+        return []
+    with json_path.open("rb") as handle:
+        prefix = handle.read(TITLE_PREFIX_SIZE)
+        # Titles with escape sequences are not matched, so they are checked only after parsing
+        found = TITLE_FIELD.search(prefix)
+        if found and found.group(1) == os.fsencode(json_dir.name):
+            return []
+        metadata: dict = json_loads(prefix + handle.read())
+    title: str = metadata.get('title', '')
+    if not title or title == json_dir.name:
+        return []
+    dir_files = list_directory(str(json_dir))
+    media_file = json_dir / title
+    # If media file has no extension (some old media has that issue)
+    if not media_file.suffix:
+        # Try all common extension
+        for extension in EXTENSIONS:
+            if f"{title}{extension}" in dir_files:
+                media_file = media_file.with_suffix(extension)
+                break
+        else:
+            # On case-insensitive filesystems, the file may be there with another case (like ".JPG")
             for extension in EXTENSIONS:
                 tmp_media = media_file.with_suffix(extension)
                 if tmp_media.is_file():
                     media_file = tmp_media
                     break
             else:
-                return f'None extension media file found for "{media_file}".'
-        # If media in title has extension, but file not found...
-        elif not media_file.is_file():
-            return f'Media file "{media_file}" not found.'
-        add_media_metadata(exiftool_exe, str(media_file), metadata)
+                raise Exception(f'None extension media file found for "{media_file}".')
+    # If media in title has extension, but file not found...
+    elif title not in dir_files and not media_file.is_file():
+        raise Exception(f'Media file "{media_file}" not found.')
+    return media_params(str(media_file), metadata)
+
+
+def process_json_files(json_paths: list[str], base_dir: pathlib.Path, metadata_dir: pathlib.Path,
+                       same_device: bool) -> list[str]:
+    """Adds metadata to a batch of media files from the same folder, on the worker ExifTool.
+    Returns an error message (or None) for each JSON file."""
+    results = [None] * len(json_paths)
+    numbers = []
+    commands = []
+    for number, json_path in enumerate(json_paths):
+        try:
+            params = read_media_params(pathlib.Path(json_path))
+        except Exception as e:
+            results[number] = f'"{json_path}": {e}'
+            continue
+        if params:
+            numbers.append(number)
+            commands.append(params)
+    if not commands:
+        return results
+    try:
+        errors = worker_exiftool.execute(commands)
+    except Exception:
+        # Run them again one by one on a new ExifTool, so only the file that broke it fails
+        restart_worker()
+        errors = []
+        for number, params in zip(numbers, commands):
+            try:
+                errors += worker_exiftool.execute([params])
+            except Exception as e:
+                restart_worker()
+                errors.append(f'"{json_paths[number]}": {e}')
+    folder_created = False
+    for number, error in zip(numbers, errors):
+        if error:
+            results[number] = error
+            continue
         # Move metadata file to folder
         if metadata_dir:
+            json_path = pathlib.Path(json_paths[number])
             new_metadata_path = metadata_dir / json_path.relative_to(base_dir)
-            os.makedirs(new_metadata_path.parent, exist_ok=True)
-            shutil.move(json_path, new_metadata_path)
-    return process_json_file
+            try:
+                # All batch files come from the same folder, so it is created once
+                if not folder_created:
+                    os.makedirs(new_metadata_path.parent, exist_ok=True)
+                    folder_created = True
+                move_metadata(json_path, new_metadata_path, same_device)
+            except Exception as e:
+                results[number] = f'"{json_path}": {e}'
+    return results
+
+
+def move_metadata(json_path: pathlib.Path, new_metadata_path: pathlib.Path, same_device: bool):
+    if same_device:
+        try:
+            os.replace(json_path, new_metadata_path)
+            return
+        except OSError as e:
+            # Bind mounts of the same filesystem share the device, but cannot rename between them
+            if e.errno != errno.EXDEV:
+                raise
+    shutil.move(json_path, new_metadata_path)
+
+
+class Progress:
+    """Processed and found JSON files counters. A background thread prints them from time to time,
+    so the results loop only increments a counter."""
+    __slots__ = ['done', 'total', 'walking', 'last_done', 'stopped', 'thread']
+
+    def __init__(self):
+        self.done = 0
+        self.total = 0
+        self.walking = True
+        self.last_done = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self.stopped.wait(PROGRESS_INTERVAL):
+            self._report()
+
+    def _report(self):
+        done = self.done
+        if done == self.last_done:
+            return
+        self.last_done = done
+        # The percentage is only known once the walk is done
+        if self.walking:
+            print(f"[*] {done} processed, {self.total} found so far...")
+        else:
+            print(f"[*] {done * 100 / self.total:.2f}% complete...")
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+        # The last interval counts were not printed yet
+        self._report()
+
+
+def bounded_map(executor: futures.Executor, func, iterable, max_pending: int):
+    """Like executor.map, but submitting lazily: it keeps at most max_pending tasks in flight.
+    executor.map submits every item upfront, holding a future for each one until the end."""
+    pending = collections.deque()
+    for item in iterable:
+        if len(pending) == max_pending:
+            yield pending.popleft().result()
+        pending.append(executor.submit(func, item))
+    while pending:
+        yield pending.popleft().result()
 
 
 def main():
@@ -143,7 +412,7 @@ def main():
     parser.add_argument("-m", "--metadata", help="Directory to move metadata files, once they are processed")
     args = parser.parse_args()
     base_dir = pathlib.Path(args.directory)
-    metadata_folder = pathlib.Path(args.metadata)
+    metadata_folder = pathlib.Path(args.metadata) if args.metadata else None
     exiftool_exe = args.exiftool
     if not os.path.isdir(base_dir):
         print(f"Error! {base_dir} is not a directory!")
@@ -152,22 +421,38 @@ def main():
         if not os.path.isdir(metadata_folder):
             print(f"Error! {metadata_folder} is not a directory!")
             exit(1)
-    json_files = list(pathlib.Path(base_dir).glob("**/*.json"))
-    last_percent = 0
-    print("[*] 0% complete...")
-    with futures.ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
-        executions = [executor.submit(prepare_process(base_dir, metadata_folder), exiftool_exe, json_path) for json_path in json_files]
-        for i, execution in enumerate(futures.as_completed(executions)):
-            try:
-                result = execution.result()
-            except Exception as e:
-                print(f"[!] {e}")
-            if result:
-                print(f"[!] Error: {result}")
-            percent = i * 10000 // len(json_files)
-            if percent > last_percent:
-                last_percent = percent
-                print(f"[*] {percent/100:.2f}% complete...")
+    # The worker processes could not tell why their ExifTool did not start
+    if shutil.which(exiftool_exe) is None:
+        print(f"Error! {exiftool_exe} executable not found!")
+        exit(1)
+    # On the same filesystem, metadata files can just be renamed
+    same_device = bool(metadata_folder) and os.stat(base_dir).st_dev == os.stat(metadata_folder).st_dev
+    cpu_count = os.cpu_count()
+    progress = Progress()
+
+    def walk_json_files():
+        # Plain strings, as they are cheaper to keep and to send to worker processes
+        skip_dir = os.path.realpath(metadata_folder) if metadata_folder else None
+        for batch in find_json_files(base_dir, skip_dir):
+            progress.total += len(batch)
+            yield batch
+        progress.walking = False
+        print(f"[*] {progress.total} metadata files found.")
+
+    print("[*] Searching and processing metadata files...")
+    worker = functools.partial(process_json_files, base_dir=base_dir, metadata_dir=metadata_folder,
+                               same_device=same_device)
+    progress.start()
+    with futures.ProcessPoolExecutor(max_workers=cpu_count, initializer=init_worker,
+                                     initargs=(exiftool_exe,)) as executor:
+        # Batches are submitted while the directory walk goes on, so the workers start right away
+        results = bounded_map(executor, worker, walk_json_files(), cpu_count * PENDING_PER_WORKER)
+        for batch_results in results:
+            for result in batch_results:
+                if result:
+                    print(f"[!] Error: {result}")
+            progress.done += len(batch_results)
+    progress.stop()
     print("[+] Done")
 
 